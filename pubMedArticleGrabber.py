@@ -2,22 +2,322 @@ try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as LET
+except ImportError:
+    LET = None
 import os
+import io
 import sys
 import time
 import pickle
 import re
 import csv
-import unicodecsv
+import codecs
+import threading
+import weakref
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.request import urlopen, Request
 from urllib.error import URLError, HTTPError
 from ssl import CertificateError
 from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from functools import lru_cache
 from Bio import Entrez
 from habanero import Crossref
 
+# downloads larger than this are discarded
+MAX_CONTENT_LENGTH = 500000000
+# the number of times a chunk of PMIDs is retried (after waiting for a minute) when Entrez does not respond
+ENTREZ_RETRIES = 5
+# the size (in bytes) of the write buffer of each CSV file. Rows are written to the disk when the buffer is full, instead of every 8 KiB (the default buffer size)
+CSV_BUFFER_SIZE = 1 << 20
+# the values of these types are written by dictTocsv as one row for each of their elements
+SEQ_TYPES = (set, list, tuple, frozenset)
+# the first bytes of the files of these extensions must start with (or contain, for pdf) one of these signatures. It rejects the HTML "access denied" pages sent instead of the articles
+MAGIC_BYTES = {'pdf': (b'%PDF',),
+               'xml': (b'<',),
+               'html': (b'<',)
+}
+# the byte order marks that may precede the '<' of xml and html files, with the encodings they stand for
+BYTE_ORDER_MARKS = ((codecs.BOM_UTF8, 'utf-8'),
+                    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+                    (codecs.BOM_UTF16_BE, 'utf-16-be')
+)
+# the state files that are read back by the grabber and usually stay unchanged between runs (for the same wanted PMIDs). Parquet snapshots of them are kept to speed up reading them. The other state files grow in every run, so their snapshots would never be read back
+STATE_FILES = ['dois']
+
+# the extensions of the content types met while downloading the articles. Other content types get their subtype as extension (e.g. 'application/epub+zip' gets 'epub+zip')
+CONTENT_TYPE_TO_EXT = {'application/pdf': 'pdf',
+                       'application/x-pdf': 'pdf',
+                       'application/octet-stream': 'pdf',
+                       'application/xml': 'xml',
+                       'text/xml': 'xml',
+                       'text/html': 'html',
+                       'text/htm': 'html',
+                       'text/plain': 'html',
+                       'application/msword': 'doc',
+                       'application/json': 'json',
+                       'application/zip': 'zip',
+                       'application/rtf': 'rtf',
+                       'text/csv': 'csv',
+                       'image/jpeg': 'jpeg',
+                       'image/png': 'png',
+                       'image/gif': 'gif',
+                       'image/tiff': 'tiff'
+}
+# the extensions (taken from content types, dispositions or urls) that are replaced by others
+EXTENSION_FIXES = {'plain': 'html',
+                   'htm': 'html',
+                   'msword': 'doc',
+                   'octet-stream': 'pdf'
+}
+
+# the regular expressions used for every article are compiled once
+EXT_RE = re.compile(r'.+\.([a-zA-Z]{3,10})"?$')
+DOMAIN_RE = re.compile(r'//(.+?)/')
+SPRINGER_RE = re.compile(r'pdf/(.+)')
+CAMBRIDGE_RE = re.compile(r'10\.1017/s(.+)')
+
+# the characters that are not allowed in file names and their replacements. All of them are single characters, so a translation table replaces them in one pass
+NOT_ALLOWED_CHAR_REPLACEMENTS = str.maketrans({
+    '/':'-',
+    '\\':'-',
+    '>':'}',
+    '<':'{',
+    ':':'_',
+    '?':'!',
+    '"':'\'',
+    '*':'+',
+    '|':'$'
+})
+
+
+@lru_cache(maxsize=None)
+def compileReplacements(substrs):
+    """Compiles (once for each set of substrings) a big OR regex that matches any of the substrings, with longer ones first"""
+    # Place longer ones first to keep shorter substrings from matching where the longer ones should take place
+    # For instance given the replacements {'ab': 'AB', 'abc': 'ABC'} against the string 'hey abc', it should produce
+    # 'hey ABC' and not 'hey ABc'
+    substrs = sorted(substrs, key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, substrs)))
+
+
+def emitRowQuoteAll(row):
+    """Formats a row of strings as csv.writer does with csv.QUOTE_ALL and the default dialect, without csv.writer's quoting scan"""
+    if len(row) == 1:
+        return '"' + row[0].replace('"', '""') + '"\r\n'
+    if not row:
+        return '\r\n'
+    return '"' + '","'.join([value.replace('"', '""') for value in row]) + '"\r\n'
+
+
+def emitColumnQuoteAll(values):
+    """Formats strings as one-column csv.QUOTE_ALL rows (one row for each string) in a single payload"""
+    return ''.join(['"' + value.replace('"', '""') + '"\r\n' for value in values])
+
+
+class QuoteAllWriter(object):
+    """
+    A csv.writer replacement for csv.QUOTE_ALL rows: rows of strings are formatted directly by emitRowQuoteAll, and the other rows (e.g. of numbers) by csv.writer.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+
+    def writerow(self, row):
+        try:
+            self.f.write(emitRowQuoteAll(row))
+        except (TypeError, AttributeError):
+            self.writer.writerow(row)
+
+    def writerows(self, rows):
+        rows = rows if isinstance(rows, list) else list(rows)
+        try:
+            text = ''.join(map(emitRowQuoteAll, rows))
+        except (TypeError, AttributeError):
+            self.writer.writerows(rows)
+            return
+        self.f.write(text)
+
+
+class CsvAppender(object):
+    """
+    Appends rows to a CSV file through a single file descriptor, instead of opening and closing the file for every row. The directory of the file is created and the headers are written (for new files) once, when the appender is created.
+    The rows are formatted by csv.writer into a string buffer, encoded to UTF-8 into a byte buffer, and the byte buffer is written to the file (with os.write) when it is full or flushed. This skips Python's layers of text and buffered files.
+
+    Usage::
+    with CsvAppender('full text/doi/bad urls', ['DOI', 'URL', 'ERROR']) as appender:
+        appender.writerow(['10.1000/xyz123', 'https://example.com/xyz123.pdf', 'Not Found'])
+    """
+
+    def __init__(self, fileName, headers=None, quoting=csv.QUOTE_MINIMAL, bufferSize=CSV_BUFFER_SIZE, syncInterval=None, syncExecutor=None):
+        """
+        :param fileName: [string] the name of the CSV file without the extension.
+        :param headers: [list] (optional) the headers, written only if the file does not exist yet.
+        :param quoting: [int] the default quoting of the rows. Rows can be written with another quoting by passing it to writerow or writerows.
+        :param bufferSize: [int] the size of the file's write buffer in bytes.
+        :param syncInterval: [float] (optional) the number of seconds after which the buffered rows are written to the file and the file is synced to the disk (with os.fsync) at the next write, so a crash loses only the rows of the last seconds. The file is not synced if it is not given.
+        :param syncExecutor: [Executor] (optional) the executor that runs the syncs, so the writing threads are not blocked while the disk syncs. The syncs run in the writing thread if it is not given.
+        """
+        self.fileName = fileName
+        directory = os.path.dirname(fileName)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # O_BINARY keeps Windows from translating the line endings
+        flags = os.O_WRONLY | os.O_APPEND | getattr(os, 'O_CLOEXEC', 0) | getattr(os, 'O_BINARY', 0)
+        # the file is created with O_EXCL, so only one appender (even of another grabber process) creates it and writes its headers
+        try:
+            self.fd = os.open(fileName + '.csv', flags | os.O_CREAT | os.O_EXCL, 0o644)
+            newFile = True
+        except FileExistsError:
+            self.fd = os.open(fileName + '.csv', flags)
+            newFile = False
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        self.syncInterval = syncInterval
+        self.syncExecutor = syncExecutor
+        self.lastSync = time.monotonic()
+        self.pendingSync = None
+        self.text = io.StringIO(newline='')
+        # a csv.writer is created once for each quoting used with the file, and reused by the next writes
+        self.writers = dict()
+        self.quoting = quoting
+        self.writer = self.getWriter(quoting)
+        # the appender can be shared by the downloading threads
+        self.lock = threading.Lock()
+        if newFile and headers:
+            # the headers are written to the file at once, before any other process appends rows to it
+            self.writerow(headers)
+            self.flush()
+
+    def getWriter(self, quoting):
+        writer = self.writers.get(quoting)
+        if writer is None:
+            # QUOTE_ALL rows do not need csv.writer's quoting scan, so they get the specialized writer
+            if quoting == csv.QUOTE_ALL:
+                writer = QuoteAllWriter(self.text)
+            else:
+                writer = csv.writer(self.text, quoting=quoting)
+            self.writers[quoting] = writer
+        return writer
+
+    def writerow(self, row, quoting=None):
+        writer = self.writer if quoting is None or quoting == self.quoting else self.getWriter(quoting)
+        with self.lock:
+            writer.writerow(row)
+            self.bufferText()
+
+    def writerows(self, rows, quoting=None):
+        writer = self.writer if quoting is None or quoting == self.quoting else self.getWriter(quoting)
+        with self.lock:
+            writer.writerows(rows)
+            self.bufferText()
+
+    def writeText(self, text):
+        """Appends text that is already formatted as CSV rows"""
+        with self.lock:
+            self.text.write(text)
+            self.bufferText()
+
+    def bufferText(self):
+        """Moves the formatted rows from the string buffer to the byte buffer, and writes the byte buffer to the file if it is full. Called with the lock held"""
+        text = self.text.getvalue()
+        self.text.seek(0)
+        self.text.truncate()
+        # characters that can not be encoded (e.g. lone surrogates in a decoded url or error message) are replaced by '?', so a single row can not break the file
+        text = text.encode('utf-8', errors='replace')
+        self.buffer += text
+        if len(self.buffer) >= self.bufferSize:
+            self.writeBuffer()
+        if self.syncInterval is not None and time.monotonic() - self.lastSync >= self.syncInterval:
+            self.sync()
+
+    def writeBuffer(self):
+        """Writes the byte buffer to the file. Called with the lock held"""
+        # os.write may write only a part of the buffer
+        while self.buffer:
+            written = os.write(self.fd, self.buffer)
+            del self.buffer[: written]
+
+    def sync(self):
+        """Writes the byte buffer to the file and syncs the file to the disk, in the background if there is a sync executor. Called with the lock held"""
+        self.writeBuffer()
+        self.lastSync = time.monotonic()
+        if self.syncExecutor is None:
+            os.fsync(self.fd)
+        elif self.pendingSync is None or self.pendingSync.done():
+            # while a sync is running, the next one is skipped. The rows written meanwhile are synced by the sync after it
+            self.pendingSync = self.syncExecutor.submit(os.fsync, self.fd)
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None:
+                self.writeBuffer()
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self.writeBuffer()
+                # the file descriptor is closed only after the background sync is done with it
+                if self.pendingSync is not None:
+                    self.pendingSync.exception()
+                    self.pendingSync = None
+                if self.syncInterval is not None:
+                    os.fsync(self.fd)
+                os.close(self.fd)
+                self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+def closeAppenders(appenders):
+    """Closes the appenders of a dict of appenders (by file name) and empties the dict"""
+    for fileName in list(appenders):
+        appender = appenders.pop(fileName, None)
+        if appender is not None:
+            appender.close()
+
+
+class WithoutKeys(Mapping):
+    """
+    A read-only view of a dict that hides some of its keys, without copying the dict. Changes to the dict are seen through the view.
+
+    Usage::
+    record = {'PMID': '1047458', 'DOI': '10.1000/xyz123', 'title': '..'}
+    view = WithoutKeys(record, ['title'])
+    dict(view)  # {'PMID': '1047458', 'DOI': '10.1000/xyz123'}
+    """
+
+    def __init__(self, d, keys):
+        self.d = d
+        self.hiddenKeys = frozenset(keys)
+
+    def __getitem__(self, key):
+        if key in self.hiddenKeys:
+            raise KeyError(key)
+        return self.d[key]
+
+    def __iter__(self):
+        return (key for key in self.d if key not in self.hiddenKeys)
+
+    def __len__(self):
+        return len(self.d) - sum(1 for key in self.hiddenKeys if key in self.d)
+
+    def __repr__(self):
+        return 'WithoutKeys(' + repr(dict(self)) + ')'
+
+
 class PubMedArticleGrabber(object):
     """
     Grabs and downloads full-text versions of PubMed records in different formats. It arranges them in folders named after the file formats (XML, PDF, ..). It is recommended to have two extra files: one containing the click through token to access articles that needs subscription, and the other containing the list of wanted PMIDs.  The names of the files are 'clickThroughToken.txt' and 'wanted.csv', respectively.
@@ -35,12 +335,17 @@ class PubMedArticleGrabber(object):
     wanted.grab()
 """
 
-    def __init__(self, pmidsListOrCSVfile, email):
+    def __init__(self, pmidsListOrCSVfile, email, apiKey=None, maxWorkers=16, maxPerHost=4, bufferSize=CSV_BUFFER_SIZE, syncInterval=30):
         """
         Constructor. Used for initialization.
 
         :param pmidsListOrCSVfile: [list, set or string] a list (or a set) of PMIDs, or a name of a CSV file  containg  the list of PMIDs with the header 'PMID'.
         :param email: [string] an email address for Entrez and Crossref in case of need to contact you (e.g. send warnigs about download limits).
+        :param apiKey: [string] (optional) an NCBI API key. It raises the Entrez rate limit from 3 to 10 requests per second.
+        :param maxWorkers: [int] (optional) the number of concurrent requests while resolving and downloading the articles.
+        :param maxPerHost: [int] (optional) the maximum number of concurrent requests sent to the same host.
+        :param bufferSize: [int] (optional) the size (in bytes) of the write buffer of each CSV file written by the grabber.
+        :param syncInterval: [float] (optional) the number of seconds after which a CSV file is written and synced to the disk (in the background), so the progress of a long run survives a crash. The syncs are time based, so the write buffers are still written in large blocks while rows are written quickly. Smaller intervals lose fewer rows in a crash but write smaller blocks more often. None disables the syncs.
 
         Usage::
         from pubMedArticleGrabber import PubMedArticleGrabber
@@ -49,14 +354,67 @@ class PubMedArticleGrabber(object):
         someOthers = PubMedArticleGrabber({'1047458', '1047458', '1050021'}, 'xxx@xxx.xx')
         """
         self.pmids = pmidsListOrCSVfile
+        self.email = email
         Entrez.email = email
-        cr = Crossref(mailto=email)
+        if apiKey:
+            Entrez.api_key = apiKey
+        self.cr = Crossref(mailto=email)
+        self.maxWorkers = maxWorkers
+        # a persistent session keeps connections alive between the (many) requests sent to the same hosts. It is shared by the downloading threads, so its pools are as large as the thread pool. Connection errors and rate limited (429) or unavailable (503) responses are retried with a backoff, respecting the Retry-After header
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max(32, maxWorkers), max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 503], raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # guards the appenders dict and the sync executor (the writes to each CSV file are serialized by the lock of its CsvAppender)
+        self.csvLock = threading.Lock()
+        self.bufferSize = bufferSize
+        self.syncInterval = syncInterval
+        # the CSV files are synced to the disk by a single background thread (started with the first file), so the writes are not blocked by the syncs
+        self.syncExecutor = None
+        # the appenders of the CSV files written during the session, by file name. Each file is opened once and all the CSV writing functions append through its appender
+        self.appenders = dict()
+        # the CSV files that were checked (and given their headers if needed) by checkHeaders
+        self.headersWritten = set()
+        self.headersLock = threading.Lock()
+        # the open files are flushed and closed when the grabber is garbage collected or the interpreter exits, in case close is not called. The finalizer does not keep the grabber alive
+        weakref.finalize(self, closeAppenders, self.appenders)
+        # downloads run concurrently, so each host gets a limited number of concurrent requests
+        self.hostSemaphores = defaultdict(lambda: threading.Semaphore(maxPerHost))
+        self.hostSemaphoresLock = threading.Lock()
+        # serializes replacing the downloaded files by their (larger) new downloads
+        self.replaceLock = threading.Lock()
+        # the directories that were already created (or found) during the session
+        self.ensuredDirs = set()
+        # the results of the open access sources: the urls found for the DOIs (positive) and the DOIs not found in any source (negative). They are loaded from (and saved to) pickles by grabViaCrossref
+        self.urlCache = dict()
+        self.negativeCache = set()
+
+
+    def close(self):
+        """Flushes and closes the CSV files opened during the session, and stops the thread syncing them"""
+        with self.csvLock:
+            syncExecutor = self.syncExecutor
+            self.syncExecutor = None
+        closeAppenders(self.appenders)
+        if syncExecutor is not None:
+            syncExecutor.shutdown(wait=True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
 
     def grab(self):
         """The main function to grab articles via both PubMedCentral and Crossref"""
+        # the rows buffered for all the CSV files are written together at the end of each phase
         self.grabViaPMCOAI()
+        self.flush()
         self.grabViaCrossref()
+        self.flush()
 
     def grabViaCrossref(self):
         """Grabs articles via Crossref, after converting PMIDs to DOIs through Entrez"""
@@ -65,8 +423,9 @@ class PubMedArticleGrabber(object):
         self.pmidTodoi(self.pmids,'dois')
 
         # reading the DOIs
-        dois = pd.read_csv('dois.csv')
-        dois = set(dois['DOI'])
+        dois = self.loadState('dois', ['DOI'])
+        dois = self.normalizeDOIs(dois['DOI'].dropna())
+        wanteddois = set(dois)
 
         # the variable "articles" is a list of dictionaries (a dictionary for each article). The dictionary is the result of querying habanero crossref using the article's doi. Here we are trying to load the variable "articles" if it was already pickled or start with an empty list.
         try:
@@ -77,22 +436,16 @@ class PubMedArticleGrabber(object):
 
         # some dois are not found in crossref. Here we are trying to read them or start with an empty set
         try:
-            notFounddois = set(self.csvTolist('full text/doi/dois notFoundin crossRef'))
+            notFounddois = self.normalizeDOIs(self.csvTolist('full text/doi/dois notFoundin crossRef'))
         except FileNotFoundError:
             notFounddois = set()
+        collecteddois = self.normalizeDOIs([article['message']['DOI'] for article in articles])
 
         # querying crossref by the dois and saving the results
         # we wrap the main process in a while loop to resume the process if it was interrupted due to network errors.
         firstTime = True
         while(dois):
             # first we filter out the dois that were already processed
-            collecteddois = set()
-            for article in articles:
-                collecteddois.add(article['message']['DOI'])
-            collecteddois = {self.extractDOI(i).lower() for i in collecteddois}
-            notFounddois = {self.extractDOI(i).lower() for i in notFounddois}
-
-            dois = {i.lower() for i in dois}
             dois = dois - notFounddois - collecteddois
             if firstTime:
                 lenOfIn = len(dois)
@@ -104,14 +457,15 @@ class PubMedArticleGrabber(object):
             # This is the main process of querying crossref for the dois that are not processed yet
             for doi in dois:
                 try:
-                    articles.append(cr.works(ids=doi))
+                    article = self.cr.works(ids=doi)
+                    articles.append(article)
+                    collecteddois.add(self.normalizeDOI(article['message']['DOI']))
                 except (HTTPError, requests.exceptions.HTTPError, URLError, CertificateError, requests.exceptions.SSLError, TimeoutError) as e:
                     if 'Not Found' in str(e):
                         notFounddois.add(doi)
                     else:
                         print(doi)
                         raise e
-        notFounddois = {self.extractDOI(i).lower() for i in notFounddois}
         self.listTocsvRows(notFounddois, 'full text/doi/dois notFoundin crossRef')
 
         # remove duplicate results
@@ -126,9 +480,7 @@ class PubMedArticleGrabber(object):
 
         # pickle the variable "articles", due to its size and to the time (network time) needed to build it.
         with open('articles.pkl', 'wb') as f:
-            pickle.dump(articles, f)
-        with open('articles.pkl', 'rb') as f:
-            articles = pickle.load(f)
+            pickle.dump(articles, f, protocol=pickle.HIGHEST_PROTOCOL)
 
         # Extracting urls that enable us to download full text articles. Some dois does not have a url in crossref
         articlesURLs = dict()
@@ -149,17 +501,16 @@ class PubMedArticleGrabber(object):
         self.listTocsvRows(doisWithNoLink, 'full text/doi/dois With No Link')
 
 
-        # Read dois and urls that are already downloaded if they exist. Also read urls that are known to be broken
+        # Read urls (and dois) that are already downloaded if they exist (only once, the set is updated with the urls downloaded afterwards). Also read urls that are known to be broken
         try:
-            downloadabledois = set(pd.read_csv('full text/doi/downloadable dois.csv')['DOI'].dropna())
-        except FileNotFoundError:
-            downloadabledois = set()
-        try:
-            downloadableURLs = set(pd.read_csv('full text/doi/downloadable dois.csv')['URL'].dropna())
+            downloadable = self.loadState('full text/doi/downloadable dois', ['DOI', 'URL'])
+            downloadableURLs = set(downloadable['URL'].dropna())
+            downloadeddois = self.normalizeDOIs(downloadable['DOI'].dropna())
         except FileNotFoundError:
             downloadableURLs = set()
+            downloadeddois = set()
         try:
-            badURLs = set(pd.read_csv('full text/doi/bad urls.csv')['URL'].dropna())
+            badURLs = set(self.loadState('full text/doi/bad urls', ['URL'])['URL'].dropna())
         except FileNotFoundError:
             badURLs = set()
 
@@ -172,23 +523,39 @@ class PubMedArticleGrabber(object):
             print('There is no XRef click through token')
             h = None
 
+        # the open access sources (OpenAlex, Europe PMC then Unpaywall) are tried first. Crossref links are used only for the articles that are not found in any of them
+        # the articles that were already downloaded (e.g. via a Crossref link in a previous run) are not resolved, since their open access url would be another url of the same article
+        self.loadResolverCaches()
+        unresolveddois = wanteddois - downloadeddois
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            openAccessURLs = dict(zip(unresolveddois, executor.map(self.resolveOpenAccessURL, unresolveddois)))
+        self.saveResolverCaches()
+
         # downloading the articles
+        # the open access articles are saved under Crossref's spelling of their DOIs (as the articles downloaded via Crossref links), so they are not saved again under a lower-case name
+        crossrefdois = {self.normalizeDOI(article['message']['DOI']): article['message']['DOI'] for article in articles}
+        knownURLs = downloadableURLs | badURLs
+        tasks = list()
+        resolveddois = dict()
+        for doi, url in openAccessURLs.items():
+            if url and url not in badURLs:
+                resolveddois[doi] = url
+                if url not in downloadableURLs:
+                    tasks.append((crossrefdois.get(doi, doi), url))
         for doi, urls_types in articlesURLs.items():
-            # if the article was available from cambridge core
-            if '10.1017/s' in doi:
-                url = self.getCambridgeURL(doi)
-                if url and url not in downloadableURLs|badURLs:
-                    self.download(doi, url, h)
-            else:
-                for url_type in urls_types:
-                    url, crContentType = url_type
-                    if url and url not in downloadableURLs|badURLs:
-                        # springer links of the form "springerlink.com/..." need to be fixed 
-                        if 'springerlink' in url:
-                            url = self.fixSpringerLinkURL(url)
-                            if url and url in downloadableURLs|badURLs:
-                                continue
-                        self.download(doi, url, h)
+            if self.normalizeDOI(doi) not in resolveddois:
+                tasks += self.crossrefTasks(doi, urls_types, knownURLs)
+        downloadableURLs |= self.downloadAll(tasks, h)
+
+        # the Crossref links of the articles whose open access url could not be downloaded (e.g. it was a landing page) are tried in the same run
+        knownURLs = downloadableURLs | badURLs
+        tasks = list()
+        for doi, urls_types in articlesURLs.items():
+            url = resolveddois.get(self.normalizeDOI(doi))
+            if url and url not in downloadableURLs:
+                tasks += self.crossrefTasks(doi, urls_types, knownURLs)
+        if tasks:
+            downloadableURLs |= self.downloadAll(tasks, h)
         print('finish')
 
         #Retry (several times) downloading bad (non-downloaded) articles to avoid timeout and similar errors
@@ -196,15 +563,16 @@ class PubMedArticleGrabber(object):
         lenOfOut = lenOfIn - 1
         while lenOfOut<lenOfIn:
             try:
-                badArticles = pd.read_csv('full text/doi/bad urls.csv')
-                badArticles = badArticles[['DOI', 'URL']].dropna()
+                # only the needed columns are parsed
+                badArticles = self.loadState('full text/doi/bad urls', ['DOI', 'URL'])
+                badArticles = badArticles.dropna()
                 badURLs = set(badArticles['URL'].dropna())
             except FileNotFoundError:
                 badArticles = pd.DataFrame(data={'DOI':[], 'URL':[]})
                 badURLs = set()
-            downloadableURLs = set(pd.read_csv('full text/doi/downloadable dois.csv')['URL'].dropna())
             lenOfIn = len(badURLs - downloadableURLs)
             # downloading the articles
+            tasks = list()
             for index, row in badArticles.iterrows():
                 doi = row['DOI']
                 url = row['URL']
@@ -214,20 +582,136 @@ class PubMedArticleGrabber(object):
                 if '10.1017/s' in doi:
                     url = self.getCambridgeURL(doi)
                     if url and url not in downloadableURLs:
-                        self.download(doi, url, h)
+                        tasks.append((doi, url))
                 elif url and url not in downloadableURLs:
                     # springer links of the form "springerlink.com/..." need to be fixed 
                     if 'springerlink' in url:
                         url = self.fixSpringerLinkURL(url)
                         if url and url in downloadableURLs:
                             continue
-                    self.download(doi, url, h)
+                    tasks.append((doi, url))
+            downloadableURLs |= self.downloadAll(tasks, h)
             print('finish')
-            downloadableURLs = set(pd.read_csv('full text/doi/downloadable dois.csv')['URL'].dropna())
             lenOfOut = len(badURLs - downloadableURLs)
         print('Remaining: ', lenOfOut ,'IDs')
 
 
+    def crossrefTasks(self, doi, urls_types, knownURLs):
+        """
+        Returns the download tasks of an article's Crossref links.
+
+        :param doi: [string] the DOI of the article, as spelled by Crossref.
+        :param urls_types: [set] the (url, content type) tuples of the article's links in Crossref.
+        :param knownURLs: [set] the urls that are already downloaded or known to be broken. They are skipped.
+        :return: [list] the (doi, url) tuples to be downloaded.
+        """
+        tasks = list()
+        # if the article was available from cambridge core
+        if '10.1017/s' in doi:
+            url = self.getCambridgeURL(doi)
+            if url and url not in knownURLs:
+                tasks.append((doi, url))
+        else:
+            for url, crContentType in urls_types:
+                if url and url not in knownURLs:
+                    # springer links of the form "springerlink.com/..." need to be fixed 
+                    if 'springerlink' in url:
+                        url = self.fixSpringerLinkURL(url)
+                        if not url or url in knownURLs:
+                            continue
+                    tasks.append((doi, url))
+        return tasks
+
+
+    def loadResolverCaches(self):
+        """Loads the pickled caches of the open access sources' results, i.e. the urls found for the DOIs (positive) and the DOIs not found in any source (negative)"""
+        try:
+            with open('urlCache.pkl', 'rb') as f:
+                self.urlCache = pickle.load(f)
+        except FileNotFoundError:
+            self.urlCache = dict()
+        try:
+            with open('negativeCache.pkl', 'rb') as f:
+                self.negativeCache = pickle.load(f)
+        except FileNotFoundError:
+            self.negativeCache = set()
+
+
+    def saveResolverCaches(self):
+        with open('urlCache.pkl', 'wb') as f:
+            pickle.dump(self.urlCache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open('negativeCache.pkl', 'wb') as f:
+            pickle.dump(self.negativeCache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def resolveOpenAccessURL(self, doi):
+        """
+        Looks for a full text url of an article in OpenAlex, Europe PMC and Unpaywall (in this order), stopping at the first source that has one. The results are cached per DOI.
+
+        :param doi: [string] the DOI of the article.
+        :return: [string] the url, or None if no source has a full text url for the article.
+        """
+        doi = self.normalizeDOI(doi)
+        if doi in self.urlCache:
+            return self.urlCache[doi]
+        if doi in self.negativeCache:
+            return None
+        failed = False
+        for source in (self.openAlexPDF, self.europePMCPDF, self.unpaywallPDF):
+            try:
+                url = source(doi)
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+                # network errors and unexpected responses are not cached, so the source is queried again in the next run
+                failed = True
+                continue
+            if url:
+                self.urlCache[doi] = url
+                return url
+        if not failed:
+            self.negativeCache.add(doi)
+        return None
+
+
+    def getJSON(self, url, params=None):
+        """Returns the JSON response of a GET request, or None if the resource is not found. The requests share the per-host limit of the downloads, so the open access sources are not flooded by the resolving threads"""
+        with self.hostSemaphore(url):
+            r = self.session.get(url, params=params, timeout=30)
+        if r.status_code == requests.codes.not_found:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+
+    def openAlexPDF(self, doi):
+        # the DOI is quoted, since legacy DOIs (e.g. SICI DOIs) may contain characters like '#', '?', '<' or '>'
+        work = self.getJSON('https://api.openalex.org/works/doi:' + requests.utils.quote(doi, safe='/'), {'mailto': self.email})
+        if work and work.get('best_oa_location'):
+            return work['best_oa_location'].get('pdf_url')
+        return None
+
+
+    def europePMCPDF(self, doi):
+        params = {'query': 'DOI:"' + doi + '"',
+                  'resultType': 'core',
+                  'format': 'json'
+        }
+        results = self.getJSON('https://www.ebi.ac.uk/europepmc/webservices/rest/search', params)
+        if not results:
+            return None
+        for result in results['resultList']['result']:
+            for fullTextUrl in result.get('fullTextUrlList', {}).get('fullTextUrl', []):
+                if fullTextUrl.get('documentStyle') == 'pdf' and fullTextUrl.get('availabilityCode') in ('OA', 'F'):
+                    return fullTextUrl['url']
+        return None
+
+
+    def unpaywallPDF(self, doi, email=None):
+        record = self.getJSON('https://api.unpaywall.org/v2/' + requests.utils.quote(doi, safe='/'), {'email': email or self.email})
+        if record and record.get('best_oa_location'):
+            return record['best_oa_location'].get('url_for_pdf')
+        return None
+
+
     def grabViaPMCOAI(self):
         """Grabs articles via PMC-OAI service, after converting PMIDs to PMCIDs through Entrez. It constructs a specific URL for each article to use the PMC-OAI service"""
         self.pmidTopmcid(self.pmids,'pmcids')
@@ -248,27 +732,74 @@ class PubMedArticleGrabber(object):
                 pmids = [row[0] for row in pmids]
         except TypeError:
             pass
-        # retreive pmcid for each pmid
-        temp = pmids
-        while temp.copy():
-            for pmid in pmids.copy():
-                handle = Entrez.elink(dbfrom="pubmed", db="pmc", LinkName="pubmed_pmc", id=pmid)
-                result = Entrez.read(handle)
-
-                pmcid=''
-                if len(result[0]['LinkSetDb']) == 1:
-                    pmcid = result[0]['LinkSetDb'][0]['Link'][0]['Id']
-                elif not result[0]['LinkSetDb']:
-                    pmcid = 'NoPMCID'
-                else:
-                    pmcid = result[0]['LinkSetDb'][0]['Link'][0]['Id'][0]
-                    pmcid += 'MoreThanPMCID'
-                    print('MoreThanPMCID')
-                    
-                row = pmid, pmcid
-                self.writecsvRow(pmcidsCSVfile, row, ['PMID', 'PMCID'])
-                pmids.remove(pmid)
-            temp = pmids
+        # retreive pmcid for each pmid, in batches of (at most) 200 PMIDs per request to the PMC ID converter
+        # the batches that failed (e.g. due to network errors) are retried in another pass, as long as each pass makes progress
+        pmids = list(pmids)
+        appender = self.checkHeaders(pmcidsCSVfile, ['PMID', 'PMCID'])
+        while pmids:
+            failed = list()
+            for i in range(0, len(pmids), 200):
+                batch = pmids[i: i+200]
+                try:
+                    rows, failedpmids = self.pmidsTopmcidsViaIdConverter(batch)
+                except requests.exceptions.RequestException:
+                    failed += batch
+                    continue
+                # the converter could not process these PMIDs, so we fall back to Entrez.elink for each of them
+                rows += [(pmid, self.pmidTopmcidViaElink(pmid)) for pmid in failedpmids]
+                appender.writerows(rows)
+            if len(failed) == len(pmids):
+                print('Remaining: ', len(failed) ,'PMIDs')
+                break
+            pmids = failed
+        appender.flush()
+
+
+    def pmidsTopmcidsViaIdConverter(self, pmids):
+        """
+        Converts a batch of (at most 200) PMIDs to PMCIDs using a single request to NCBI's PMC ID converter API.
+
+        :param pmids: [list] PMIDs to be converted.
+        :return: [tuple] a list of (pmid, pmcid) rows and a list of the PMIDs the converter failed to process.
+        """
+        params = {'ids': ','.join(str(pmid) for pmid in pmids),
+                  'idtype': 'pmid',
+                  'format': 'json',
+                  'tool': 'pubmed-articles-grabber',
+                  'email': Entrez.email
+        }
+        r = self.session.post('https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/', data=params)
+        r.raise_for_status()
+
+        rows = list()
+        failedpmids = list()
+        for record in r.json().get('records', []):
+            pmid = str(record.get('pmid', record.get('requested-id', '')))
+            if record.get('status') == 'error':
+                failedpmids.append(pmid)
+            elif record.get('pmcid'):
+                # keep the numeric form of the PMCID, as returned by Entrez.elink
+                rows.append((pmid, record['pmcid'][3:] if record['pmcid'].startswith('PMC') else record['pmcid']))
+            else:
+                rows.append((pmid, 'NoPMCID'))
+        return rows, failedpmids
+
+
+    def pmidTopmcidViaElink(self, pmid):
+        """Converts a single PMID to a PMCID through Entrez.elink"""
+        handle = Entrez.elink(dbfrom="pubmed", db="pmc", LinkName="pubmed_pmc", id=pmid)
+        result = Entrez.read(handle)
+
+        pmcid=''
+        if len(result[0]['LinkSetDb']) == 1:
+            pmcid = result[0]['LinkSetDb'][0]['Link'][0]['Id']
+        elif not result[0]['LinkSetDb']:
+            pmcid = 'NoPMCID'
+        else:
+            pmcid = result[0]['LinkSetDb'][0]['Link'][0]['Id'][0]
+            pmcid += 'MoreThanPMCID'
+            print('MoreThanPMCID')
+        return pmcid
 
 
     def pmcidToXml (self, pmcid):
@@ -276,69 +807,87 @@ class PubMedArticleGrabber(object):
         page = urlopen(url)
         xml = page.read()
         fileName = 'full text/pmcid/xml/' +str(pmcid)+ '.xml'
-        directory = os.path.dirname(fileName)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        self.ensureDirectory(fileName)
         with open(fileName, 'wb') as f:
             f.write(xml)
 
 
     def xmlToTxt (self, pmcid):
-        noTxt = False
         fileName = 'full text/pmcid/xml/'+ str(pmcid)
-        directory = os.path.dirname(fileName)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-
-        tree = ET.parse(fileName + '.xml')
-        root = tree.getroot()
-        rootNS, _ = root.tag.split('}')
-        rootNS = rootNS [1 :]
-        nsmap = {'rootNS':rootNS}
-        metadata = root.find('.//rootNS:metadata', nsmap)
+        txtFileName = 'full text/pmcid/txt/' +str(pmcid)+ '.txt'
+        self.ensureDirectory(txtFileName)
+
+        # The text of the article's body is streamed to the txt file while parsing the XML file, so neither the tree nor the text is kept in memory.
+        # The text (or tail) of an element is complete only when the next event is reached, so each event writes the text part that precedes it: the text of the element started by the previous event, or the tail of the element ended by it.
+        # The parts are separated by spaces, as in ' '.join(ET.tostringlist(body, method='text')).
+        inMetadata = False
+        body = None
+        previousEvent, previousElem = None, None
+        txtFile = None
+        if LET is not None:
+            # lxml's (C) parser is faster. Comments and processing instructions are removed, so the text around them stays in the text and tails of the elements, as with ElementTree
+            events = LET.iterparse(fileName + '.xml', events=('start', 'end'), remove_comments=True, remove_pis=True)
+        else:
+            events = ET.iterparse(fileName + '.xml', events=('start', 'end'))
         try:
-            article = metadata[0]
-        except TypeError:
-            article = None
-            noTxt = True
-        if article:
-            articleNS, temp = article.tag.split('}')
-            assert temp == 'article', 'No article tag'
-            del(temp)
-            articleNS = articleNS[1 :]
-            nsmap['articleNS'] = articleNS
-            body = article.find('.//articleNS:body', nsmap)
-            if body:
-                txt = ' '.join(ET.tostringlist(body, encoding='unicode', method='text'))
-                fileName = 'full text/pmcid/txt/' +str(pmcid)+ '.txt'
-                directory = os.path.dirname(fileName)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                with open('full text/pmcid/txt/' +str(pmcid)+ '.txt', 'wb') as txtFile:
-                    txtFile.write(txt.encode('utf-8'))
-            else:
-                noTxt = True
+            for event, elem in events:
+                if body is None:
+                    tag = elem.tag.split('}')[-1]
+                    if event == 'start' and tag == 'metadata':
+                        inMetadata = True
+                    elif event == 'start' and tag == 'body' and inMetadata:
+                        body = elem
+                        previousEvent, previousElem = event, elem
+                    elif event == 'end':
+                        elem.clear()
+                    continue
+
+                part = previousElem.text if previousEvent == 'start' else previousElem.tail
+                if part:
+                    if txtFile is None:
+                        txtFile = open(txtFileName, 'wb')
+                    else:
+                        txtFile.write(b' ')
+                    txtFile.write(part.encode('utf-8'))
+                if previousEvent == 'end':
+                    # the element is not needed anymore after writing its tail
+                    previousElem.clear()
+                if event == 'end' and elem is body:
+                    break
+                previousEvent, previousElem = event, elem
+        finally:
+            if txtFile is not None:
+                txtFile.close()
 
+        noTxt = txtFile is None
         return noTxt
 
 
     def getFullText(self, pmcids):
         noTxt=list()
-        temp = pmcids
-        while temp.copy():
-            for pmcid in pmcids.copy():
+        # the PMCIDs whose XML could not be fetched (e.g. due to network errors) are retried in another pass, as long as each pass makes progress
+        while pmcids:
+            failed = set()
+            for pmcid in pmcids:
                 purePmcid = int(''.join(filter(str.isdigit, pmcid)))
-                self.pmcidToXml(purePmcid)
+                try:
+                    self.pmcidToXml(purePmcid)
+                except (HTTPError, URLError, TimeoutError, ConnectionResetError):
+                    failed.add(pmcid)
+                    continue
                 if self.xmlToTxt(purePmcid):
                     noTxt.append(purePmcid)
                     print(purePmcid)
-                pmcids.remove(pmcid)
-            temp = pmcids
+            if len(failed) == len(pmcids):
+                print('Remaining: ', len(failed) ,'PMCIDs')
+                break
+            pmcids = failed
         return noTxt
 
 
     def pmidEntrezSummaryRecordTodoi(self, esummaryRecord):
-        summaryRecord = esummaryRecord[0]
+        # accepts either a single summary record or the list returned by Entrez.read for a single PMID
+        summaryRecord = esummaryRecord[0] if isinstance(esummaryRecord, list) else esummaryRecord
         pmid = summaryRecord['Id']
         try:
             doi = summaryRecord['DOI']
@@ -403,45 +952,85 @@ class PubMedArticleGrabber(object):
         dois = set()
         print(len(pmids))
         print('fetching..')
+        # esummary accepts up to 200 comma-separated PMIDs per request
         counter = 0
-        for pmid in pmids:
-            counter+=1
-    #        print(pmid, counter)
-
-            try:
-                summaryHandle = Entrez.esummary(db='pubmed', id=pmid)
-            except URLError:
-                print('server time out')
-                time.sleep(60)
-                print('woke up from server time out')
-            try:
-                summaryRecord = Entrez.read(summaryHandle)
+        pmids = iter(pmids)
+        chunk = [str(pmid) for pmid in islice(pmids, 200)]
+        # the results are appended to the CSV files after each chunk, through the session's appenders
+        doisAppender = self.checkHeaders(doisCSVfile, ['PMID', 'DOI'])
+        unicodeErrorAppender = self.getAppender('unicode Error pmids', quoting=csv.QUOTE_ALL)
+        notFoundpmidsAppender = self.getAppender('not Found pmids', quoting=csv.QUOTE_ALL)
+        notFounddoisAppender = self.getAppender('not Found dois', quoting=csv.QUOTE_ALL)
+        retries = 0
+        try:
+            while chunk:
                 try:
-                    doi = self.pmidEntrezSummaryRecordTodoi(summaryRecord)
-                    pmid_doi[pmid] = self.extractDOI(doi).lower()
-                except ValueError:
-                    notFounddois.add(pmid)
-    #                print('no doi', pmid, counter)
-            except (UnicodeDecodeError, UnicodeEncodeError):
-                unicodeErrorpmids.add(pmid)
-                print('unicode', pmid, counter)
-            except RuntimeError as e:
-                notFoundpmid = re.findall('\d+', str(e))[0]
-                assert pmid == notFoundpmid
-                notFoundpmids.add(pmid)
-                print('no record', pmid, counter)
-
-            if counter % 1000 == 0 or counter == len(pmids):
-                self.dictTocsv(pmid_doi, doisCSVfile, ['PMID', 'DOI'])
-                self.listTocsvRows(unicodeErrorpmids,'unicode Error pmids')
-                self.listTocsvRows(notFoundpmids, 'not Found pmids')
-                self.listTocsvRows(notFounddois, 'not Found dois')
-                time.sleep(15)
+                    summaryHandle = Entrez.esummary(db='pubmed', id=','.join(chunk))
+                    summaryRecords = Entrez.read(summaryHandle)
+                except URLError as e:
+                    # a client error (4xx) is caused by the request itself (e.g. a malformed PMID in the chunk), so it is not retried. The records of the chunk are fetched one by one instead
+                    if isinstance(e, HTTPError) and 400 <= e.code < 500:
+                        summaryRecords = None
+                    else:
+                        retries += 1
+                        if retries > ENTREZ_RETRIES:
+                            raise
+                        print('server time out')
+                        time.sleep(60)
+                        print('woke up from server time out')
+                        continue
+                except (UnicodeDecodeError, UnicodeEncodeError, RuntimeError):
+                    summaryRecords = None
+                retries = 0
+                failedpmids = set()
+                if summaryRecords is None:
+                    # a record of this chunk can not be read, so we fetch the records of the chunk one by one
+                    summaryRecords = list()
+                    for pmid in chunk:
+                        try:
+                            summaryRecords += Entrez.read(Entrez.esummary(db='pubmed', id=pmid))
+                        except (UnicodeDecodeError, UnicodeEncodeError):
+                            unicodeErrorpmids.add(pmid)
+                            print('unicode', pmid, counter)
+                        except RuntimeError:
+                            notFoundpmids.add(pmid)
+                            print('no record', pmid, counter)
+                        except URLError as e:
+                            if isinstance(e, HTTPError) and 400 <= e.code < 500:
+                                notFoundpmids.add(pmid)
+                                print('no record', pmid, counter)
+                            else:
+                                # the PMID is not recorded anywhere, so it is fetched again in the next run
+                                failedpmids.add(pmid)
+                                print('server error', pmid, counter)
+                counter += len(chunk)
+
+                fetchedpmids = set()
+                for summaryRecord in summaryRecords:
+                    pmid = str(summaryRecord['Id'])
+                    fetchedpmids.add(pmid)
+                    try:
+                        doi = self.pmidEntrezSummaryRecordTodoi(summaryRecord)
+                        pmid_doi[pmid] = self.normalizeDOI(doi)
+                    except ValueError:
+                        notFounddois.add(pmid)
+                # PMIDs with no summary record in the response are not found in PubMed
+                for pmid in set(chunk) - fetchedpmids - unicodeErrorpmids - notFoundpmids - failedpmids:
+                    notFoundpmids.add(pmid)
+                    print('no record', pmid, counter)
+
+                doisAppender.writerows(pmid_doi.items())
+                unicodeErrorAppender.writerows([pmid] for pmid in unicodeErrorpmids)
+                notFoundpmidsAppender.writerows([pmid] for pmid in notFoundpmids)
+                notFounddoisAppender.writerows([pmid] for pmid in notFounddois)
                 pmid_doi=dict()
                 unicodeErrorpmids = set()
                 notFoundpmids = set()
                 notFounddois = set()
-                print('woke up')                    
+                chunk = [str(pmid) for pmid in islice(pmids, 200)]
+        finally:
+            for appender in (doisAppender, unicodeErrorAppender, notFoundpmidsAppender, notFounddoisAppender):
+                appender.flush()
 
 
     def writeXMLWithHeaderFrom(self, fileNameOfHeaderFile, fileNameOfOutFile, tree=None):
@@ -456,57 +1045,47 @@ class PubMedArticleGrabber(object):
             tree.write(outf)
 
     def getExtension(self, filePathOrURL):
-        ext = re.findall('.+\.([a-zA-Z]{3,10})"?$', filePathOrURL)
+        ext = EXT_RE.findall(filePathOrURL)
         if ext:
             return ext[-1]
         else:
             return None
 
     def decideExtension(self, dictionaryOfcontentTypesDispositionURL):
-        try:
-            contentType = dictionaryOfcontentTypesDispositionURL['contentType']
-        except KeyError:
-            contentType = None
-        try:
-            crContentType = dictionaryOfcontentTypesDispositionURL['crContentType']
-        except KeyError:
-            crContentType = None
-        try:
-            contentDisposition = dictionaryOfcontentTypesDispositionURL['contentDisposition']
-        except KeyError:
-            contentDisposition = None
-        try:
-            url = dictionaryOfcontentTypesDispositionURL['url']
-        except KeyError:
-            url = None
+        contentType = dictionaryOfcontentTypesDispositionURL.get('contentType')
+        crContentType = dictionaryOfcontentTypesDispositionURL.get('crContentType')
+        contentDisposition = dictionaryOfcontentTypesDispositionURL.get('contentDisposition')
+        url = dictionaryOfcontentTypesDispositionURL.get('url')
 
         if contentType:
-            ext = contentType.split('/')[-1].split(';')[0]
+            ext = self.contentTypeToExtension(contentType)
     #        print('type')
         elif crContentType and crContentType != 'unspecified':
-            ext = crContentType.split('/')[-1].split(';')[0]
+            ext = self.contentTypeToExtension(crContentType)
     #        print('cr')
         elif contentDisposition:
             ext = self.getExtension(contentDisposition)
     #        print('dispo')
-        elif self.getExtension(url):
+        elif url:
             ext = self.getExtension(url)
     #        print('url')
         else:
             ext = None
     #        print('non')
 
-        if 'api.elsevier' in url and (ext == 'plain' or ext == 'htm'or ext == 'html'):
+        ext = EXTENSION_FIXES.get(ext, ext)
+        if url and 'api.elsevier' in url and ext == 'html':
             ext = 'txt'
-        elif ext == 'plain' or ext == 'htm':
-            ext = 'html'
-        elif ext == 'msword':
-            ext = 'doc'
-        elif ext == 'octet-stream':
-            ext = 'pdf'
 
         return ext
 
+    def contentTypeToExtension(self, contentType):
+        mediaType = contentType.split(';')[0]
+        ext = CONTENT_TYPE_TO_EXT.get(mediaType.strip().lower())
+        if ext is None:
+            ext = mediaType.split('/')[-1]
+        return ext
+
 
     def multireplace(self, string, replacements):
         """
@@ -518,67 +1097,146 @@ class PubMedArticleGrabber(object):
         :rtype: str
 
         """
-        # Place longer ones first to keep shorter substrings from matching where the longer ones should take place
-        # For instance given the replacements {'ab': 'AB', 'abc': 'ABC'} against the string 'hey abc', it should produce
-        # 'hey ABC' and not 'hey ABc'
-        substrs = sorted(replacements, key=len, reverse=True)
-
-        # Create a big OR regex that matches any of the substrings to replace
-        regexp = re.compile('|'.join(map(re.escape, substrs)))
+        # Create (or reuse) a big OR regex that matches any of the substrings to replace
+        regexp = compileReplacements(frozenset(replacements))
 
         # For each match, look up the new string in the replacements
         return regexp.sub(lambda match: replacements[match.group(0)], string)
 
-    def extractDOI(self, doiLinkOrTag):
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def extractDOI(doiLinkOrTag):
         return doiLinkOrTag.split('org/')[-1]
 
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def normalizeDOI(doiLinkOrTag):
+        """Extracts the DOI of a link or tag in lower case. DOIs are normalized once, when they enter the grabber's sets and dicts"""
+        return PubMedArticleGrabber.extractDOI(doiLinkOrTag).lower()
+
+    def normalizeDOIs(self, doiLinksOrTags):
+        """Extracts the DOIs of many links or tags at once (using pandas string methods) and returns them in lower case as a set"""
+        dois = pd.Series(list(doiLinksOrTags), dtype='string')
+        return set(dois.str.rsplit('org/').str[-1].str.lower())
+
     def createFile(self, doi, ext=None):
-        notAllowedCharReplacements = { 
-            '/':'-',
-            '\\':'-',
-            '>':'}',
-            '<':'{',
-            ':':'_',
-            '?':'!',
-            '"':'\'',
-            '*':'+',
-            '|':'$'
-        }
         if ext:
-            fileName = 'full text/doi3/'+ext+'/'+self.multireplace(doi, notAllowedCharReplacements)+ '.'+ext
+            fileName = 'full text/doi3/'+ext+'/'+doi.translate(NOT_ALLOWED_CHAR_REPLACEMENTS)+ '.'+ext
         else:
-            fileName = 'full text/doi3/other/'+self.multireplace(doi, notAllowedCharReplacements)
-        directory = os.path.dirname(fileName)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+            fileName = 'full text/doi3/other/'+doi.translate(NOT_ALLOWED_CHAR_REPLACEMENTS)
+        self.ensureDirectory(fileName)
         return fileName
 
 
-    def getDomain(self, url):
-        domain = re.findall('//(.+?)/', url)
+    def ensureDirectory(self, fileName):
+        """Creates the directory of a file if it does not exist, checking each directory only once per session"""
+        directory = os.path.dirname(fileName)
+        if directory and directory not in self.ensuredDirs:
+            os.makedirs(directory, exist_ok=True)
+            self.ensuredDirs.add(directory)
+
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def getDomain(url):
+        domain = DOMAIN_RE.findall(url)
         if domain:
             return domain[-1]
         else:
             return None
 
 
-    def fixSpringerLinkURL(self, url):
-        doi = re.findall('pdf/(.+)', url)[-1]
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def fixSpringerLinkURL(url):
+        doi = SPRINGER_RE.findall(url)[-1]
         doi = doi.replace('/', '%2F')
         newURL = 'https://link.springer.com/content/pdf/' + doi
         return newURL
 
 
-    def getCambridgeURL(self, doi):
-        doi = re.findall('10.1017/s(.+)', doi)[-1]
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def getCambridgeURL(doi):
+        doi = CAMBRIDGE_RE.findall(doi)[-1]
         newURL = 'https://www.cambridge.org/core/services/aop-cambridge-core/content/view/S' + doi
         return newURL
 
 
+    def downloadAll(self, tasks, requestHeaders, maxWorkers=None):
+        """
+        Downloads the articles concurrently using a pool of threads.
+
+        :param tasks: [list] (doi, url) tuples of the articles to be downloaded. Repeated urls are downloaded only once.
+        :param requestHeaders: [dict] headers sent with every request (e.g. the click-through-token).
+        :param maxWorkers: [int] (optional) the number of concurrent downloads. Defaults to the grabber's maxWorkers.
+        :return: [set] the urls that were downloaded successfully.
+        """
+        if maxWorkers is None:
+            maxWorkers = self.maxWorkers
+        # the tasks are interleaved by host, so the workers are not all blocked waiting for the same host's (limited) slots while other hosts are idle
+        tasks = self.interleaveByHost(tasks)
+        seenURLs = set()
+        downloadedURLs = set()
+        # the results are appended to these CSV files through the session's appenders (opened here, before the downloading threads start)
+        appenders = [self.checkHeaders('full text/doi/downloadable dois', ['DOI', 'URL', 'EXT']), self.checkHeaders('full text/doi/bad urls', ['DOI', 'URL', 'ERROR'])]
+        try:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                futures = dict()
+                for doi, url in tasks:
+                    if url in seenURLs:
+                        continue
+                    seenURLs.add(url)
+                    futures[executor.submit(self.downloadPolitely, doi, url, requestHeaders)] = doi, url
+                for future in as_completed(futures):
+                    try:
+                        downloadedURL = future.result()
+                        if downloadedURL:
+                            downloadedURLs.add(downloadedURL)
+                    except Exception as e:
+                        doi, url = futures[future]
+                        print(doi, url, repr(e))
+        finally:
+            for appender in appenders:
+                appender.flush()
+        return downloadedURLs
+
+
+    def interleaveByHost(self, tasks):
+        """Reorders (doi, url) tasks in a round robin over their urls' hosts"""
+        tasksByHost = defaultdict(list)
+        for doi, url in tasks:
+            tasksByHost[self.getDomain(url)].append((doi, url))
+        queues = [iter(hostTasks) for hostTasks in tasksByHost.values()]
+        interleaved = list()
+        while queues:
+            remainingQueues = list()
+            for queue in queues:
+                task = next(queue, None)
+                if task is not None:
+                    interleaved.append(task)
+                    remainingQueues.append(queue)
+            queues = remainingQueues
+        return interleaved
+
+
+    def downloadPolitely(self, doi, url, requestHeaders):
+        """Downloads an article while limiting the number of concurrent requests sent to the article's host"""
+        with self.hostSemaphore(url):
+            return self.download(doi, url, requestHeaders)
+
+
+    def hostSemaphore(self, url):
+        """Returns the semaphore that limits the number of concurrent requests sent to the url's host"""
+        with self.hostSemaphoresLock:
+            return self.hostSemaphores[self.getDomain(url)]
+
+
     def download(self, doi, url, requestHeaders):
+        """Downloads an article and returns its url if it was downloaded successfully, or None otherwise"""
         downloadableViaRequests = False
         try:
-            r = requests.head(url, headers=requestHeaders, allow_redirects=True)
+            r = self.session.head(url, headers=requestHeaders, allow_redirects=True)
             try:
                 remainingHits = int(r.headers['CR-TDM-Rate-Limit-Remaining'])
                 resetTime = int(r.headers['CR-TDM-Rate-Limit-Reset'][: -3])
@@ -597,56 +1255,33 @@ class PubMedArticleGrabber(object):
     #        print(str(e))
             pass
         if downloadableViaRequests:
-            self.downloadViaRequests(doi, url, requestHeaders)
+            return self.downloadViaRequests(doi, url, requestHeaders)
     #        print('downloading via requests')
         else:
-            self.downloadViaUrlLib(doi, url, requestHeaders)
+            return self.downloadViaUrlLib(doi, url, requestHeaders)
     #        print('downloading via urllib')
 
 
     def downloadViaRequests(self, doi, url, requestHeaders):
         try:
-            content = requests.get(url, headers=requestHeaders, allow_redirects=True) #, stream=True)
-            try:
-                contentType = content.headers['content-type']
-            except KeyError:
-                contentType = None
-            try:
-                contentDisposition = content.headers['content-disposition']
-            except KeyError:
-                contentDisposition = None
+            with self.session.get(url, headers=requestHeaders, allow_redirects=True, stream=True) as content:
+                contentType = content.headers.get('content-type')
+                contentDisposition = content.headers.get('content-disposition')
+
+                d = {'contentType':contentType,
+                     'contentDisposition':contentDisposition,
+                     'url':url
+                }
+                ext = self.decideExtension(d)
+                fileName = self.createFile(doi, ext)
+                rejection = self.saveStream(fileName, ext, content.iter_content(65536), content.headers.get('content-length'))
+            if rejection:
+                self.writecsvRow('full text/doi/bad urls', [doi, url, rejection], ['DOI', 'URL', 'ERROR'])
+                return
 
-            d = {'contentType':contentType,
-                 'contentDisposition':contentDisposition,
-                 'url':url
-            }
-
-            content = content.content
-            contentSize = int(sys.getsizeof(content))
-            fileSize = 0
-            ext = self.decideExtension(d)
-            fileName = self.createFile(doi, ext)
-        #    print(fileName)
-            if os.path.exists(fileName):
-                fileSize = os.path.getsize(fileName)
-        #        print(contentSize, fileSize)
-            if contentSize-33 > fileSize:
-                with open(fileName, 'wb') as f:
-        #            print('writingFile')
-        #            for chunk in content.iter_content(chunk_size=1024):
-        #                if chunk:
-                    f.write(content)
-
-            fileName = 'full text/doi/downloadable dois'
-            directory = os.path.dirname(fileName)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
             self.writecsvRow('full text/doi/downloadable dois', [doi, url, ext], ['DOI', 'URL', 'EXT'])
+            return url
         except (requests.exceptions.HTTPError, requests.exceptions.Timeout, requests.exceptions.SSLError, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
-            fileName = 'full text/doi/bad urls'
-            directory = os.path.dirname(fileName)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
             self.writecsvRow('full text/doi/bad urls', [doi, url, str(e)], ['DOI', 'URL', 'ERROR'])
         except:
             print(doi, url)
@@ -659,51 +1294,163 @@ class PubMedArticleGrabber(object):
             if requestHeaders is not None:
                 k, v = next(iter(requestHeaders.items()))
                 req.add_header(k, v)
-            urlibContent = urlopen(req)
-            try:
+            with urlopen(req) as urlibContent:
                 contentType = urlibContent.info()['Content-Type']
-            except KeyError:
-                contentType = None
 
-            d = {'contentType':contentType,
-                 'url':url
-            }
-            content = urlibContent.read()
-            contentSize = sys.getsizeof(content)
-            fileSize = 0
-            ext = self.decideExtension(d)
-            fileName = self.createFile(doi, ext)
-    #        print(fileName)
-            if os.path.exists(fileName):
-                fileSize = os.path.getsize(fileName)
-    #            print(contentSize, fileSize)
-            if contentSize-33 > fileSize:
-                with open(fileName, 'wb') as f:
-    #                print('writingFile')
-    #                for chunk in content.iter_content(chunk_size=1024):
-    #                    if chunk:
-                    f.write(content)
-
-            fileName = 'full text/doi/downloadable dois'
-            directory = os.path.dirname(fileName)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+                d = {'contentType':contentType,
+                     'url':url
+                }
+                ext = self.decideExtension(d)
+                fileName = self.createFile(doi, ext)
+                chunks = iter(lambda: urlibContent.read(65536), b'')
+                rejection = self.saveStream(fileName, ext, chunks, urlibContent.info()['Content-Length'])
+            if rejection:
+                self.writecsvRow('full text/doi/bad urls', [doi, url, rejection], ['DOI', 'URL', 'ERROR'])
+                return
+
             self.writecsvRow('full text/doi/downloadable dois', [doi, url, ext], ['DOI', 'URL', 'EXT'])
+            return url
     #                print('created bad file')
         except (HTTPError, TimeoutError, URLError, ConnectionResetError, CertificateError) as e:
-            fileName = 'full text/doi/downloadable dois'
-            directory = os.path.dirname(fileName)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
             self.writecsvRow('full text/doi/bad urls', [doi, url, str(e)], ['DOI', 'URL', 'ERROR'])
         except:
             print(doi, url)
             raise
 
 
+    def saveStream(self, fileName, ext, chunks, contentLength=None):
+        """
+        Streams downloaded content to a file chunk by chunk, after checking its first bytes against the expected signature of its extension. The file is replaced only if the new content is larger than the existing one.
+
+        :param fileName: [string] the path of the file.
+        :param ext: [string] the extension decided for the content.
+        :param chunks: [iterable] the chunks (bytes) of the content.
+        :param contentLength: [string or int] (optional) the announced size of the content.
+        :return: [string] the reason for rejecting the content, or None if it was accepted.
+        """
+        if contentLength and int(contentLength) > MAX_CONTENT_LENGTH:
+            return 'Content too large: ' + str(contentLength) + ' bytes'
+
+        # the signature is checked against (at least) the first 1024 bytes
+        chunks = iter(chunks)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= 1024:
+                break
+        if ext in MAGIC_BYTES:
+            if ext == 'pdf':
+                valid = any(magic in head[: 1024] for magic in MAGIC_BYTES[ext])
+            else:
+                valid = self.startsWithMarkup(head)
+            if not valid:
+                return 'Content is not a valid ' + ext + ' file'
+
+        # each download gets its own part file, since several urls of the same DOI (e.g. a pdf link and an unspecified link that is also a pdf) may be downloaded to the same file at the same time
+        # (a thread downloads one url at a time, so the thread's id makes the name unique)
+        partFileName = fileName + '.' + str(threading.get_ident()) + '.part'
+        contentSize = len(head)
+        try:
+            with open(partFileName, 'wb') as f:
+                f.write(head)
+                for chunk in chunks:
+                    contentSize += len(chunk)
+                    if contentSize > MAX_CONTENT_LENGTH:
+                        break
+                    f.write(chunk)
+        except BaseException:
+            os.remove(partFileName)
+            raise
+        if contentSize > MAX_CONTENT_LENGTH:
+            os.remove(partFileName)
+            return 'Content too large: more than ' + str(MAX_CONTENT_LENGTH) + ' bytes'
+
+        # the size of the existing file is compared and the file is replaced as one step, so the larger of two concurrent downloads is kept
+        with self.replaceLock:
+            fileSize = 0
+            if os.path.exists(fileName):
+                fileSize = os.path.getsize(fileName)
+            if contentSize > fileSize:
+                os.replace(partFileName, fileName)
+            else:
+                os.remove(partFileName)
+        return None
+
+
+    def startsWithMarkup(self, head):
+        """Checks whether the first bytes of a file start with '<' (after whitespace), as xml and html files do. A byte order mark (UTF-8 or UTF-16) is skipped and the bytes are decoded accordingly"""
+        for bom, encoding in BYTE_ORDER_MARKS:
+            if head.startswith(bom):
+                return head[len(bom):].decode(encoding, errors='ignore').lstrip().startswith('<')
+        return head.lstrip().startswith(b'<')
+
+
+    def loadState(self, fileName, columns=None):
+        """
+        Reads a state CSV file (e.g. 'dois' or 'full text/doi/bad urls') as a DataFrame. The CSV files are append-only logs. For the files of STATE_FILES, a Parquet snapshot is kept and is read instead of the CSV file as long as the CSV file has the same size and modification time (in nanoseconds) it had when the snapshot was taken. The first read of such a file creates its snapshot.
+
+        :param fileName: [string] the name of the CSV file without the extension.
+        :param columns: [list] (optional) the columns to read. Only these columns are parsed from the files without snapshots.
+        :return: [DataFrame] the content of the file.
+        """
+        self.flush(fileName)
+        csvFileName = fileName + '.csv'
+        if fileName not in STATE_FILES:
+            return pd.read_csv(csvFileName, usecols=columns, dtype='string', engine='c')
+        parquetFileName = fileName + '.parquet'
+        # the state of the CSV file is taken before reading it, so rows appended while reading it invalidate the snapshot
+        stamp = self.stateStamp(csvFileName)
+        try:
+            with open(parquetFileName + '.stamp', 'r') as f:
+                if f.read() == stamp:
+                    return pd.read_parquet(parquetFileName, columns=columns)
+        except FileNotFoundError:
+            pass
+        df = pd.read_csv(csvFileName)
+        self.saveState(df, fileName, stamp)
+        return df[columns] if columns else df
+
+
+    def stateStamp(self, csvFileName):
+        """Returns the size and the modification time (in nanoseconds) of a state CSV file, as a string. Appending rows to the file changes its size, even when the file system's timestamps are too coarse to change its modification time"""
+        stat = os.stat(csvFileName)
+        return str(stat.st_size) + ' ' + str(stat.st_mtime_ns)
+
+
+    def saveState(self, df, fileName, stamp):
+        """Saves a Parquet (zstd compressed) snapshot of a state DataFrame, with the stamp (see stateStamp) of the CSV file it was read from"""
+        try:
+            df.to_parquet(fileName + '.parquet', compression='zstd')
+        except (ImportError, TypeError, ValueError):
+            # no Parquet engine is installed, or a column has mixed types that can not be stored in Parquet
+            return
+        with open(fileName + '.parquet.stamp', 'w') as f:
+            f.write(stamp)
+
+
     def csvTolist(self, csvFileName):
+        self.flush(csvFileName)
+        # the file is parsed by pandas' C parser. Empty cells are kept as empty strings (not NaN) to be filtered out
+        try:
+            df = pd.read_csv(csvFileName+'.csv', header=None, dtype='string', keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError:
+            return list()
+        except pd.errors.ParserError:
+            # pandas takes the number of fields from the first row, so files whose rows have different numbers of fields (e.g. written by listTocsvCols) are read by csv.reader
+            return self.csvTolistViaReader(csvFileName)
+        if df.shape[1] == 1:
+            cells = [cell for cell in df[0].tolist() if cell]
+        else:
+            rows = (list(filter(None, row)) for row in df.itertuples(index=False, name=None))
+            cells = [row[0] if len(row) == 1 else row for row in rows if row]
+        if len(cells) == 1:
+            cells = cells[0]
+        return cells
+
+
+    def csvTolistViaReader(self, csvFileName):
         cells = list()
-        with open(csvFileName+'.csv', 'r') as inf:
+        with open(csvFileName+'.csv', 'r', newline='', encoding='utf-8') as inf:
             r = csv.reader(inf)
             for row in r:
                 row = list(filter(None,row))
@@ -711,113 +1458,140 @@ class PubMedArticleGrabber(object):
                     row = row[0]
                 if row:
                     cells.append(row)
-            if len(cells) == 1:
-                cells = cells[0]
+        if len(cells) == 1:
+            cells = cells[0]
         return cells
 
 
     def csvTodict(self, csvFileName):
+        self.flush(csvFileName)
         mydict = defaultdict(set)
-        with open(csvFileName+'.csv', 'r') as f:
-            csvin = csv.reader(f)
-            for row in csvin:
-                k, v = row[0], row[1]
-                mydict = self.addToDict(mydict, k, v)
+        try:
+            df = pd.read_csv(csvFileName+'.csv', header=None, usecols=[0, 1], dtype='string', keep_default_na=False, engine='c')
+        except pd.errors.EmptyDataError:
+            return mydict
+        # repeated values (e.g. the same DOI for several PMIDs) are interned, so the sets share a single copy of each of them
+        intern = sys.intern
+        for k, v in zip(df[0].tolist(), df[1].tolist()):
+            mydict[k].add(intern(v) if type(v) is str else v)
         return mydict
 
-    def checkHeaders(self, csvFileName, headers):
-        if headers is None and not os.path.isfile(csvFileName+'.csv'):
-            raise FileExistsError('We need the headers to crearte the file for the first time.')
-        elif headers and not os.path.isfile(csvFileName+'.csv'):
-            with open(csvFileName+'.csv', 'a', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(headers)
+    def getAppender(self, fileName, headers=None, quoting=csv.QUOTE_MINIMAL):
+        """
+        Returns the session's appender of a CSV file, opening the file the first time it is written. The appender is kept open (and reused by the next calls) until close is called.
+
+        :param fileName: [string] the name of the CSV file without the extension.
+        :param headers: [list] (optional) the headers, written only if the file does not exist yet.
+        :param quoting: [int] the default quoting of the file's rows, set when the file is opened.
+        :return: [CsvAppender] the appender of the file.
+        """
+        appender = self.appenders.get(fileName)
+        if appender is None:
+            with self.csvLock:
+                appender = self.appenders.get(fileName)
+                if appender is None:
+                    if self.syncInterval is not None and self.syncExecutor is None:
+                        self.syncExecutor = ThreadPoolExecutor(max_workers=1)
+                    appender = CsvAppender(fileName, headers, quoting, self.bufferSize, self.syncInterval, self.syncExecutor)
+                    self.appenders[fileName] = appender
+        return appender
+
+
+    def flush(self, fileName=None):
+        """
+        Flushes the buffered rows of a CSV file (or of all the files) opened during the session, so they can be read. The rows are buffered by file, so each file is written with a single write for all its pending rows.
+
+        :param fileName: [string] (optional) the name of the CSV file without the extension. All the files are flushed if it is not given.
+        """
+        if fileName is None:
+            with self.csvLock:
+                appenders = list(self.appenders.values())
+        else:
+            appenders = [self.appenders[fileName]] if fileName in self.appenders else []
+        for appender in appenders:
+            appender.flush()
+
+
+    def checkHeaders(self, csvFileName, headers, quoting=csv.QUOTE_MINIMAL):
+        # the existence of the file (and of its headers) is checked only at the first call for each file. The set is checked again under the lock, in case another thread checked the file meanwhile
+        if csvFileName not in self.headersWritten:
+            with self.headersLock:
+                if csvFileName not in self.headersWritten:
+                    if headers is None and not os.path.isfile(csvFileName+'.csv'):
+                        raise FileExistsError('We need the headers to crearte the file for the first time.')
+                    appender = self.getAppender(csvFileName, headers, quoting)
+                    self.headersWritten.add(csvFileName)
+                    return appender
+        return self.getAppender(csvFileName, headers, quoting)
 
     def dictTocsv(self, mydict, csvFileName, headers=None):
-        self.checkHeaders(csvFileName, headers)
-        unicodeDict=dict()
-        with open(csvFileName+'.csv', 'a', newline='') as f:
-            writer = csv.writer(f)
-            for key, value in mydict.items():
-                try:
-                    if type(value) is set or type(value) is list:
-                        for x in value:
-                            writer.writerow([key, x])
-                    else:
-                        writer.writerow([key, value])
-                except (UnicodeEncodeError, UnicodeDecodeError):
-                    unicodeDict[key] = value
-        with open(csvFileName+'.csv', 'ab') as f:
-            writer = unicodecsv.writer(f, encoding='utf-8')
-            for key, value in unicodeDict.items():
-                if type(value) is set or type(value) is list:
-                    for x in value:
-                        writer.writerow([key, x])
-                else:
-                    writer.writerow([key, value])
+        appender = self.checkHeaders(csvFileName, headers)
+        # the rows are built first, then written with a single writerows call
+        rows = list()
+        append = rows.append
+        extend = rows.extend
+        for key, value in mydict.items():
+            if isinstance(value, SEQ_TYPES):
+                extend((key, x) for x in value)
+            else:
+                append((key, value))
+        appender.writerows(rows)
 
     def listTocsvCols(self, li, fileName):
-        containsUnicode=False
-        with open(fileName+'.csv', 'a', newline='') as csvFile:
-            liFile = csv.writer(csvFile, quoting=csv.QUOTE_ALL)
-            try:
-                liFile.writerow(li)
-            except (UnicodeEncodeError, UnicodeDecodeError):
-                containsUnicode=True
-        if containsUnicode:
-            with open(fileName+'.csv', 'ab') as csvFile:
-                liFile = unicodecsv.writer(csvFile, encoding='utf-8', quoting=csv.QUOTE_ALL)
-                liFile.writerow(li)
+        appender = self.getAppender(fileName, quoting=csv.QUOTE_ALL)
+        appender.writerow(li, csv.QUOTE_ALL)
 
 
     def listTocsvRows(self, li, fileName):
-        containsUnicode=False
-        directory = os.path.dirname(fileName)
-        if '/' in directory and not os.path.exists(directory):
-            os.makedirs(directory)
-        with open(fileName+'.csv', 'a', newline='') as csvFile:
-            liFile = csv.writer(csvFile, quoting=csv.QUOTE_ALL)
-            try:
-                liFile.writerows([i] for i in li)
-            except (UnicodeEncodeError, UnicodeDecodeError):
-                containsUnicode=True
-        if containsUnicode:
-            with open(fileName+'.csv', 'ab') as csvFile:
-                liFile = unicodecsv.writer(csvFile, encoding='utf-8', quoting=csv.QUOTE_ALL)
-                liFile.writerows([i] for i in li)
+        # the directory of the file is created by its appender, when the file is opened
+        appender = self.getAppender(fileName, quoting=csv.QUOTE_ALL)
+        li = li if isinstance(li, SEQ_TYPES) else list(li)
+        # a list of strings (e.g. PMIDs or DOIs) is formatted as one payload, without building a row for each item
+        try:
+            payload = emitColumnQuoteAll(li)
+        except (TypeError, AttributeError):
+            appender.writerows([[i] for i in li], csv.QUOTE_ALL)
+            return
+        appender.writeText(payload)
 
 
     def writecsvRow(self, fileName, row, headers=None):
-        self.checkHeaders(fileName, headers)
-        containsUnicode=False
-        with open(fileName + '.csv', 'a', newline='') as f:
-            csvout = csv.writer(f)
-            try:
-                csvout.writerow(row)
-            except (UnicodeEncodeError, UnicodeDecodeError):
-                containsUnicode=True
-        if containsUnicode:
-            with open(fileName+'.csv', 'ab') as f:
-              csvout = unicodecsv.writer(f, encoding='utf-8')
-              csvout.writerow(row)
+        self.writecsvRows(fileName, [row], headers)
+
+
+    def writecsvRows(self, fileName, rows, headers=None):
+        # the rows are appended through the file's appender, which is shared by the downloading threads
+        self.checkHeaders(fileName, headers).writerows(rows)
 
 
     def addToDict(self, mydict, k, v):
-        d = defaultdict(set, mydict)
-        d[k] |= {v}
+        """Adds v to the set of the key k in mydict (in place, without copying the dict) and returns mydict"""
+        # repeated string values (e.g. DOIs) are interned, so the sets share a single copy of each of them
+        if type(v) is str:
+            v = sys.intern(v)
+        mydict.setdefault(k, set()).add(v)
+        return mydict
+
+
+    def asKeys(self, keys):
+        """Returns keys as a collection of keys: a single key (e.g. a string) is wrapped in a tuple"""
+        if isinstance(keys, str) or not hasattr(keys, '__iter__'):
+            return (keys,)
+        return keys
+
+
+    def removeKeysInplace(self, d, keys):
+        """Removes a key (or a collection of keys) from d in place, ignoring the missing ones, and returns d"""
+        for key in self.asKeys(keys):
+            d.pop(key, None)
         return d
 
 
+    def withoutKeys(self, d, keys):
+        """Returns a read-only view of d without a key (or a collection of keys). The dict is not copied"""
+        return WithoutKeys(d, self.asKeys(keys))
+
+
     def removeKey(self, d, keys):
-        r = dict(d)
-        try:
-            for key in keys:
-                try:
-                    del r[key]
-                except KeyError:
-                    pass
-        except TypeError:
-            del r[keys]
-        except KeyError:
-            pass
-        return r
+        """Returns a copy of d without a key (or a collection of keys). Use removeKeysInplace or withoutKeys to avoid copying the dict"""
+        return self.removeKeysInplace(dict(d), keys)
@@ -45,7 +45,14 @@ setup(
 
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),  # Required
 
-    install_requires=['unicodecsv', 'pandas', 'requests', 'habanero', 'biopython'],  # Optional
+    # pandas reads the state CSV files (the dois, downloadable dois and bad urls) that grabViaCrossref works on. The CSV files are written without it
+    install_requires=['pandas', 'requests', 'habanero', 'biopython'],  # Optional
+
+    # lxml is used (if installed) to parse the XML files faster, and pyarrow (if installed) to keep Parquet snapshots of the state CSV files
+    extras_require={  # Optional
+        'lxml': ['lxml'],
+        'parquet': ['pyarrow'],
+    },
 
 
     # If there are data files included in your packages that need to be